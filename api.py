@@ -9,47 +9,686 @@ Directory layout expected next to this file:
 """
 
 import os
-import io
-import base64
+import atexit
+import binascii
+import hashlib
+import json
 import logging
+import logging.handlers
+import queue
+import threading
+import time
 import traceback
-import tempfile
+from collections import OrderedDict
 
+import cv2
+import numpy as np
+import orjson
 import pandas as pd
-from PIL import Image
-from flask import Flask, request, jsonify, send_from_directory
+import tensorflow as tf
+from flask import Flask, Response, request, send_from_directory
 from flask_cors import CORS
+from deepface import DeepFace
+
+from config import (
+    EXCEL_PATH, DB_PATH, STATIC_DIR, CONFIDENCE_THRESHOLD, ARCFACE_ONNX,
+    SHEET_PARQUET, GALLERY_NPY, GALLERY_META, GALLERY_FAISS,
+    MODEL_NAME, DETECTOR_BACKEND, MATCH_DISTANCE, IMAGE_EXTS, ARCFACE_INPUT, DETECT_MAX_SIDE,
+    TRT_CALIBRATION, BATCH_MAX, BATCH_WAIT_MS, FAISS_MIN_SIZE, RESULT_CACHE_MAX, DETECT_CACHE_MAX,
+    arcface_input,
+)
+
+try:
+    import faiss                   # optional – only used for large galleries
+except ImportError:
+    faiss = None
+
+try:
+    from turbojpeg import TurboJPEG   # optional – scaled JPEG decoding via libjpeg-turbo
+    _TJ = TurboJPEG()
+except Exception:                  # package or the native libturbojpeg missing
+    _TJ = None
+
+try:
+    import onnxruntime as ort      # optional – serves ArcFace from ARCFACE_ONNX (see export_onnx.py)
+except ImportError:
+    ort = None
 
 # ─────────────────────────────────────────────
 #  Logging  (writes to stdout → captured by Gunicorn)
+#  Request threads only merge the message arguments (QueueHandler.prepare) and
+#  enqueue the record; a QueueListener thread adds the prefix and does the
+#  blocking stdout writes.
 # ─────────────────────────────────────────────
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(name)s – %(message)s",
-)
+_LOG_HANDLER = logging.StreamHandler()
+_LOG_HANDLER.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(name)s – %(message)s"))
+_LOG_QUEUE_HANDLER = logging.handlers.QueueHandler(queue.Queue(-1))
+# prepare() bakes the queue handler's own format into record.msg – keep it to the bare
+# message, or basicConfig's BASIC_FORMAT ends up in front of every line
+_LOG_QUEUE_HANDLER.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=logging.INFO, handlers=[_LOG_QUEUE_HANDLER])
+
+
+def _start_log_listener():
+    """Fresh queue + listener thread (also run in each forked worker – threads do not survive fork)."""
+    global _LOG_LISTENER
+    _LOG_QUEUE_HANDLER.queue = queue.Queue(-1)
+    _LOG_LISTENER = logging.handlers.QueueListener(_LOG_QUEUE_HANDLER.queue, _LOG_HANDLER)
+    _LOG_LISTENER.start()
+
+
+_start_log_listener()
+os.register_at_fork(after_in_child=_start_log_listener)
+atexit.register(lambda: _LOG_LISTENER.stop())             # flush what is still queued
 logger = logging.getLogger("safe_return")
 
 
 # ─────────────────────────────────────────────
-#  Config  (override via environment variables)
+#  Image-hash caches  (SHA-1 of the decoded image bytes → value, capped LRU)
+#    results : encoded JSON response body – bypassed once the data changes on disk, cleared when it is reloaded
+#    detect  : aligned 112×112 BGR uint8 face – independent of the gallery, never cleared; it only
+#              hits for images whose result is gone, so it must hold more entries than  results
 # ─────────────────────────────────────────────
-BASE_DIR             = os.path.dirname(os.path.abspath(__file__))
-EXCEL_PATH           = os.environ.get("EXCEL_PATH",  os.path.join(BASE_DIR, "sheet.xlsx"))
-DB_PATH              = os.environ.get("DB_PATH",     os.path.join(BASE_DIR, "data"))
-STATIC_DIR           = os.environ.get("STATIC_DIR",  os.path.join(BASE_DIR, "static"))
-CONFIDENCE_THRESHOLD = float(os.environ.get("CONFIDENCE_THRESHOLD", "0.6"))
+class _LRU:
+    """Thread-safe OrderedDict LRU that evicts the oldest entry beyond  maxsize.
+
+    generation  counts the clear() calls: a value computed from data read before a
+    clear() is dropped by put() instead of outliving the reload that cleared the cache.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize    = maxsize
+        self.generation = 0
+        self._data      = OrderedDict()
+        self._lock      = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value, generation=None):
+        """Store  value  (unless the cache was cleared since  generation ) and return it."""
+        with self._lock:
+            if generation is None or generation == self.generation:
+                self._data[key] = value
+                self._data.move_to_end(key)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.generation += 1
+
+
+_RESULT_CACHE = _LRU(RESULT_CACHE_MAX)
+_DETECT_CACHE = _LRU(DETECT_CACHE_MAX)
+
 
-# Lazy-import DeepFace so the app starts quickly even when running health checks
-def _deepface():
-    from deepface import DeepFace  # noqa
-    return DeepFace
+# ─────────────────────────────────────────────
+#  Name lookup  (Excel converted to Parquet once, reloaded only when the file changes)
+# ─────────────────────────────────────────────
+_NAME_CACHE  = {}
+_EXCEL_MTIME = None
+_NAME_LOCK   = threading.Lock()
+
+
+def _mtime(path):
+    """os.path.getmtime, or -1.0 while  path  is missing / unreadable (a state like any other)."""
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return -1.0
+
+
+def _read_excel():
+    try:
+        return pd.read_excel(EXCEL_PATH, engine="calamine")
+    except (ImportError, ValueError):
+        return pd.read_excel(EXCEL_PATH)
+
+
+def _ensure_parquet():
+    """(Re)write SHEET_PARQUET unless it was converted from the current Excel sheet; returns its path.
+
+    The sheet's  mtime_ns:size  is stored in the Parquet metadata and must match exactly –
+    a newer-than check would keep a stale copy when the sheet is replaced by an older file
+    (cp -p, rsync -t, restore from backup).
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    st     = os.stat(EXCEL_PATH)
+    source = f"{st.st_mtime_ns}:{st.st_size}".encode()
+    try:
+        if (pq.read_schema(SHEET_PARQUET).metadata or {}).get(b"source_excel") == source:
+            return SHEET_PARQUET
+    except (OSError, pa.ArrowException):
+        pass
+
+    table = pa.Table.from_pandas(_read_excel()[["Inmate Id", "Name"]].astype(str), preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"source_excel": source})
+    tmp   = f"{SHEET_PARQUET}.{os.getpid()}.tmp"
+    pq.write_table(table, tmp)
+    os.replace(tmp, SHEET_PARQUET)
+    logger.info("Converted %s → %s", EXCEL_PATH, SHEET_PARQUET)
+    return SHEET_PARQUET
+
+
+def _read_names():
+    """Read the sheet (via its Parquet copy) into an  Inmate Id → Name  dict."""
+    try:
+        df = pd.read_parquet(_ensure_parquet(), columns=["Inmate Id", "Name"])
+    except (OSError, ImportError, ValueError, TypeError) as exc:     # Arrow errors subclass these
+        logger.warning("Parquet copy unavailable (%s), reading %s directly", exc, EXCEL_PATH)
+        df = _read_excel()
+    return dict(zip(df["Inmate Id"].astype(str), df["Name"].astype(str)))
+
+
+def _load_names():
+    """Return the cached name map, re-reading the Excel only if its mtime changed.
+
+    A missing or unreadable sheet is recorded like any other version of it: logged once,
+    the names loaded before (if any) stay in use until the file changes again.
+    """
+    global _NAME_CACHE, _EXCEL_MTIME
+    mtime = _mtime(EXCEL_PATH)
+    if mtime == _EXCEL_MTIME:
+        return _NAME_CACHE
+    with _NAME_LOCK:
+        if mtime != _EXCEL_MTIME:
+            try:
+                _NAME_CACHE = _read_names()
+                _RESULT_CACHE.clear()
+                logger.info("Loaded %d names from %s", len(_NAME_CACHE), EXCEL_PATH)
+            except Exception as exc:
+                logger.warning("Could not read Excel %s (keeping %d names): %s",
+                               EXCEL_PATH, len(_NAME_CACHE), exc)
+            _EXCEL_MTIME = mtime
+    return _NAME_CACHE
+
+
+_load_names()
+
+
+# ─────────────────────────────────────────────
+#  ArcFace inference  (ONNX Runtime / TensorRT when ARCFACE_ONNX exists,
+#  otherwise DeepFace's TensorFlow model)
+# ─────────────────────────────────────────────
+_ORT_SESSION = None
+_ORT_INPUT   = None
+_ORT_INT8    = False
+_ORT_PID     = None              # CUDA / TensorRT contexts do not survive fork – one session per process
+_ORT_LOCK    = threading.Lock()
+
+
+def _load_onnx():
+    """InferenceSession for ARCFACE_ONNX (TensorRT INT8 → CUDA → CPU) and its int8 flag, or (None, False)."""
+    if ort is None or not os.path.exists(ARCFACE_ONNX):
+        return None, False
+    onnx_dir = os.path.dirname(os.path.abspath(ARCFACE_ONNX))
+    shape    = "x".join(map(str, (*ARCFACE_INPUT, 3)))
+    trt_opts = {
+        "trt_engine_cache_enable": True,
+        "trt_engine_cache_path":   onnx_dir,
+        # One engine for every batch size the batcher can send (input name from export_onnx.py);
+        # without a profile TensorRT rebuilds the engine for each new, larger batch on the request path
+        "trt_profile_min_shapes":  f"input:1x{shape}",
+        "trt_profile_opt_shapes":  f"input:{BATCH_MAX}x{shape}",
+        "trt_profile_max_shapes":  f"input:{BATCH_MAX}x{shape}",
+    }
+    if os.path.exists(os.path.join(onnx_dir, TRT_CALIBRATION)):
+        trt_opts.update(trt_int8_enable=True, trt_int8_calibration_table_name=TRT_CALIBRATION)
+
+    available = ort.get_available_providers()
+    providers = [p for p in [("TensorrtExecutionProvider", trt_opts),
+                             "CUDAExecutionProvider", "CPUExecutionProvider"]
+                 if (p[0] if isinstance(p, tuple) else p) in available]
+    session = ort.InferenceSession(ARCFACE_ONNX, providers=providers)
+    int8    = (session.get_providers()[0] == "TensorrtExecutionProvider" and
+               trt_opts.get("trt_int8_enable", False))
+    logger.info("ArcFace served from %s via %s (int8=%s)", ARCFACE_ONNX, session.get_providers()[0], int8)
+    return session, int8
+
+
+def _onnx_session():
+    """This process's ONNX session (created on first use), or None to run ArcFace on TensorFlow."""
+    global _ORT_SESSION, _ORT_INPUT, _ORT_INT8, _ORT_PID
+    if _ORT_PID != os.getpid():
+        with _ORT_LOCK:
+            if _ORT_PID != os.getpid():
+                try:
+                    session, int8 = _load_onnx()
+                except Exception as exc:
+                    logger.warning("Could not load %s, falling back to DeepFace: %s", ARCFACE_ONNX, exc)
+                    session, int8 = None, False
+                _ORT_SESSION = session
+                _ORT_INPUT   = session.get_inputs()[0].name if session is not None else None
+                _ORT_INT8    = int8
+                _ORT_PID     = os.getpid()
+    return _ORT_SESSION
+
+
+def _decode(img_bytes):
+    """Raw image bytes → BGR uint8 array, or None if they cannot be decoded.
+
+    JPEGs go through TurboJPEG at the smallest 1/2, 1/4 or 1/8 scale that keeps the
+    longer side ≥ DETECT_MAX_SIDE (the IDCT does the downscaling almost for free).
+    Everything else – PNGs, JPEGs with EXIF (cv2 honours the orientation tag, TurboJPEG
+    does not), TurboJPEG errors – is decoded by cv2.imdecode.
+    """
+    if _TJ is not None and img_bytes[:2] == b"\xff\xd8" and b"Exif\x00\x00" not in img_bytes[:65536]:
+        try:
+            w, h  = _TJ.decode_header(img_bytes)[:2]
+            denom = 1
+            while denom < 8 and max(w, h) // (denom * 2) >= DETECT_MAX_SIDE:
+                denom *= 2
+            return _TJ.decode(img_bytes, scaling_factor=(1, denom) if denom > 1 else None)
+        except Exception as exc:
+            logger.warning("TurboJPEG decode failed, falling back to OpenCV: %s", exc)
+    return cv2.imdecode(np.frombuffer(img_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def _downscale(arr):
+    """Shrink a BGR image so its longer side is at most DETECT_MAX_SIDE (never upscales)."""
+    h, w  = arr.shape[:2]
+    scale = DETECT_MAX_SIDE / max(h, w)
+    if scale >= 1:
+        return arr
+    size  = (max(1, round(w * scale)), max(1, round(h * scale)))   # extreme aspect ratios: never 0 px
+    return cv2.resize(arr, size, interpolation=cv2.INTER_AREA)
+
+
+def _detect(img, enforce_detection):
+    """Detect + align the first face in  img  (path or BGR array) → (112,112,3) BGR uint8 crop."""
+    faces = DeepFace.extract_faces(
+        img_path          = img,
+        detector_backend  = DETECTOR_BACKEND,
+        enforce_detection = enforce_detection,
+        align             = True,
+    )
+    face = arcface_input(faces[0]["face"])[0]
+    return np.clip(np.rint(face * np.float32(255)), 0, 255).astype(np.uint8)
+
+
+_ARCFACE_MODEL = None           # the bare Keras model behind DeepFace's ArcFace wrapper
+
+
+def _arcface_model():
+    global _ARCFACE_MODEL
+    if _ARCFACE_MODEL is None:
+        _ARCFACE_MODEL = DeepFace.build_model(MODEL_NAME).model
+    return _ARCFACE_MODEL
+
+
+def _forward(batch):
+    """One ArcFace forward pass:  (B,112,112,3) BGR uint8 → (B,512) float32.
+
+    Calls the model directly: crops are already aligned and in ArcFace's BGR
+    order, so only the single uint8 → [0,1] float32 scaling is left to do.
+    """
+    x = np.multiply(batch, np.float32(1 / 255), dtype=np.float32)
+    session = _onnx_session()
+    if session is not None:
+        out = session.run(None, {_ORT_INPUT: x})[0]
+    else:
+        out = _arcface_model()(x, training=False).numpy()
+    return np.asarray(out, dtype=np.float32)
+
+
+# ─────────────────────────────────────────────
+#  Micro-batching  (concurrent requests share one ArcFace forward pass)
+#  Request threads enqueue  (face, done, slot)  and wait; one worker thread per
+#  process gathers up to BATCH_MAX faces for at most BATCH_WAIT_MS and runs them together.
+# ─────────────────────────────────────────────
+_BATCH_QUEUE = None
+_BATCH_PID   = None              # threads do not survive fork – restart in each worker
+_BATCH_LOCK  = threading.Lock()
+
+
+def _batch_worker(q):
+    while True:
+        items    = [q.get()]
+        deadline = time.monotonic() + BATCH_WAIT_MS / 1000
+        while len(items) < BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(q.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        try:
+            results = _forward(np.stack([face for face, _, _ in items]))
+        except Exception as exc:
+            results = [exc] * len(items)
+        for (_, done, slot), result in zip(items, results):
+            slot.append(result)
+            done.set()
+
+
+def _batch_queue():
+    global _BATCH_QUEUE, _BATCH_PID
+    if _BATCH_PID != os.getpid():
+        with _BATCH_LOCK:
+            if _BATCH_PID != os.getpid():
+                _BATCH_QUEUE = queue.Queue()
+                threading.Thread(target=_batch_worker, args=(_BATCH_QUEUE,),
+                                 name="arcface-batcher", daemon=True).start()
+                _BATCH_PID   = os.getpid()
+    return _BATCH_QUEUE
+
+
+def _embed(face):
+    """Embed one aligned face via the batch worker → 512-d float32 vector."""
+    done, slot = threading.Event(), []
+    _batch_queue().put((face, done, slot))
+    done.wait()
+    if isinstance(slot[0], Exception):
+        raise slot[0]
+    return slot[0]
+
+
+# ─────────────────────────────────────────────
+#  Gallery  (L2-normalised ArcFace embeddings of every photo in DB_PATH,
+#  persisted to GALLERY_NPY and memory-mapped so workers share one copy)
+#  A changed DB_PATH is brought up to date by a background thread – only new or
+#  changed photos are embedded – while requests keep using the previous snapshot.
+# ─────────────────────────────────────────────
+_GALLERY        = None           # (matrix, [person_id …], FAISS index or None, [entry …], [entry …]) – swapped whole
+_DB_SEEN        = None           # DB_PATH mtime the last (re)build was started for
+_GALLERY_ERROR  = None           # why the last (re)build failed
+_GALLERY_THREAD = None
+_GALLERY_LOCK   = threading.Lock()
+
+
+def _l2_normalize(x):
+    norm = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.maximum(norm, 1e-12)
+
+
+def _db_entries():
+    """Sorted  (name, size, mtime_ns)  of the photos in DB_PATH – one entry per gallery photo.
+
+    Unlike the folder's own mtime an entry also changes when a photo is replaced in place.
+    """
+    return sorted(
+        (e.name, e.stat().st_size, e.stat().st_mtime_ns)
+        for e in os.scandir(DB_PATH)
+        if e.is_file() and e.name.lower().endswith(IMAGE_EXTS)
+    )
+
+
+def _build_gallery(entries, known, skipped):
+    """Gallery for  entries,  embedding only the photos not already in  known  ({entry: row}) or  skipped.
+
+    Returns  (N,512) float32 matrix, [entry …] of its rows, [entry …] without a usable face.
+    """
+    fresh, no_face = {}, set()
+    faces, pending = [], []
+
+    def flush():
+        if faces:
+            fresh.update(zip(pending, _l2_normalize(_forward(np.stack(faces)))))
+            faces.clear()
+            pending.clear()
+
+    for entry in entries:
+        if entry in known or entry in skipped:
+            continue
+        try:
+            faces.append(_detect(os.path.join(DB_PATH, entry[0]), enforce_detection=True))
+            pending.append(entry)
+        except Exception as exc:
+            logger.warning("Skipping gallery image %s: %s", entry[0], exc)
+            no_face.add(entry)
+            continue
+        if len(faces) >= BATCH_MAX:
+            flush()
+    flush()
+
+    files   = [e for e in entries if e in known or e in fresh]
+    skipped = [e for e in entries if e in skipped or e in no_face]
+    logger.info("Gallery: %d photos embedded, %d reused", len(fresh), len(files) - len(fresh))
+    if not files:
+        return np.empty((0, 512), dtype=np.float32), files, skipped
+    gallery = np.stack([known[e] if e in known else fresh[e] for e in files]).astype(np.float32, copy=False)
+    return gallery, files, skipped
+
+
+def _person_ids(files):
+    return [os.path.splitext(name)[0] for name, _, _ in files]
+
+
+def _gallery_backend():
+    """Tag for what produced the embeddings – a saved gallery from anything else is rebuilt."""
+    if _onnx_session() is None:
+        return f"{MODEL_NAME}/{DETECTOR_BACKEND}/tensorflow"
+    return (f"{MODEL_NAME}/{DETECTOR_BACKEND}/onnx:"
+            f"{os.stat(ARCFACE_ONNX).st_mtime_ns}:int8={_ORT_INT8}")
+
+
+def _read_saved_gallery():
+    """Memory-map GALLERY_NPY if it was built from this DB_PATH with this backend.
+
+    Returns  (matrix, [entry …] of its rows, [entry …] without a face)  or None.  The entries
+    may be out of date – the caller re-embeds whatever changed since.
+    """
+    try:
+        with open(GALLERY_META, encoding="utf-8") as fh:
+            meta = json.load(fh)
+        st = os.stat(GALLERY_NPY)
+        if (meta.get("db_path") != os.path.abspath(DB_PATH) or
+                meta.get("backend") != _gallery_backend() or
+                meta.get("npy")     != [st.st_size, st.st_mtime_ns]):
+            return None
+        gallery = np.load(GALLERY_NPY, mmap_mode="r")
+        files   = [tuple(e) for e in meta["files"]]
+        skipped = [tuple(e) for e in meta["skipped"]]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if len(gallery) != len(files):
+        return None
+    return gallery, files, skipped
+
+
+def _save_gallery(gallery, files, skipped):
+    """Write the gallery to GALLERY_NPY and hand back a read-only memmap of it.
+
+    Every worker maps the same file, so the matrix lives once in the OS page cache
+    instead of once per process.  GALLERY_META is written last and pins the exact
+    .npy it describes (size + mtime), so a half-finished save is never trusted.
+    """
+    if not files:
+        return gallery
+    try:
+        tmp = f"{GALLERY_NPY}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as fh:
+            np.save(fh, gallery)
+        os.replace(tmp, GALLERY_NPY)
+        st   = os.stat(GALLERY_NPY)
+        meta = {
+            "db_path": os.path.abspath(DB_PATH),
+            "backend": _gallery_backend(),
+            "npy":     [st.st_size, st.st_mtime_ns],
+            "files":   files,
+            "skipped": skipped,
+            "ids":     _person_ids(files),
+        }
+        tmp = f"{GALLERY_META}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(meta, fh)
+        os.replace(tmp, GALLERY_META)
+        return np.load(GALLERY_NPY, mmap_mode="r")
+    except OSError as exc:
+        logger.warning("Could not save gallery to %s: %s", GALLERY_NPY, exc)
+        return gallery
+
+
+def _build_index(gallery, reuse_saved):
+    """HNSW inner-product index over the (normalised) gallery, or None to use the exact scan.
+
+    When the gallery itself came from GALLERY_NPY ( reuse_saved ), the index saved next to it
+    is read back instead of rebuilding the graph.  Only persisted galleries get a saved index.
+    """
+    if faiss is None or len(gallery) < FAISS_MIN_SIZE:
+        return None
+    if reuse_saved:
+        try:
+            if os.path.getmtime(GALLERY_FAISS) >= os.path.getmtime(GALLERY_NPY):
+                index = faiss.read_index(GALLERY_FAISS)
+                if index.ntotal == len(gallery):
+                    logger.info("FAISS index read from %s", GALLERY_FAISS)
+                    return index
+        except (OSError, RuntimeError):
+            pass
+
+    index = faiss.IndexHNSWFlat(gallery.shape[1], 32, faiss.METRIC_INNER_PRODUCT)
+    index.add(np.ascontiguousarray(gallery))
+    if isinstance(gallery, np.memmap):
+        try:
+            tmp = f"{GALLERY_FAISS}.{os.getpid()}.tmp"
+            faiss.write_index(index, tmp)
+            os.replace(tmp, GALLERY_FAISS)
+        except (OSError, RuntimeError) as exc:
+            logger.warning("Could not save FAISS index to %s: %s", GALLERY_FAISS, exc)
+    return index
+
+
+def _rebuild_gallery():
+    """Bring the gallery up to date with DB_PATH and swap the new snapshot in (background thread)."""
+    global _GALLERY, _GALLERY_ERROR, _DB_SEEN
+    try:
+        entries = _db_entries()
+        if _GALLERY is not None:
+            gallery, _, _, files, skipped = _GALLERY
+        else:
+            gallery, files, skipped = (_read_saved_gallery() or
+                                       (np.empty((0, 512), dtype=np.float32), [], []))
+        current = sorted(files + skipped) == entries
+        if current and _GALLERY is not None:
+            return                               # only non-photo files changed
+        if current:
+            logger.info("Gallery mapped from %s", GALLERY_NPY)
+        else:
+            gallery, files, skipped = _build_gallery(entries, dict(zip(files, gallery)), set(skipped))
+            gallery = _save_gallery(gallery, files, skipped)
+        index = _build_index(gallery, reuse_saved=current)
+    except Exception as exc:
+        _GALLERY_ERROR = exc
+        if _GALLERY is None:
+            _DB_SEEN = None                      # nothing to serve yet – the next request tries again
+        logger.error("Could not load gallery from %s: %s", DB_PATH, exc)
+        return
+
+    _GALLERY = (gallery, _person_ids(files), index, files, skipped)
+    _RESULT_CACHE.clear()
+    logger.info("Gallery ready: %d embeddings from %s (%s)", len(files), DB_PATH,
+                "FAISS HNSW" if index is not None else "exact scan")
+
+
+def _load_gallery(wait=False):
+    """Return the current  (matrix, [person_id …], index)  snapshot.
+
+    A changed DB_PATH starts a background rebuild and the previous snapshot is returned
+    until it has been swapped in.  Only while there is no snapshot yet (or with  wait )
+    does the caller block on the rebuild; if that failed, its error is raised.
+    """
+    global _DB_SEEN, _GALLERY_THREAD
+    mtime = _mtime(DB_PATH)
+    if mtime != _DB_SEEN and not (_GALLERY_THREAD and _GALLERY_THREAD.is_alive()):
+        with _GALLERY_LOCK:
+            if mtime != _DB_SEEN and not (_GALLERY_THREAD and _GALLERY_THREAD.is_alive()):
+                _DB_SEEN        = mtime
+                _GALLERY_THREAD = threading.Thread(target=_rebuild_gallery, name="gallery-rebuild", daemon=True)
+                _GALLERY_THREAD.start()
+    if _GALLERY is None or wait:
+        _GALLERY_THREAD.join()
+        if _GALLERY is None:
+            raise _GALLERY_ERROR
+    return _GALLERY[:3]
+
+
+def _sources_changed():
+    """True if DB_PATH or the Excel sheet changed since they were last loaded."""
+    return _mtime(DB_PATH) != _DB_SEEN or _mtime(EXCEL_PATH) != _EXCEL_MTIME
+
+
+def _best_match(gallery, gallery_ids, index, query):
+    """Cosine nearest neighbour.  Returns  (person_id, distance)  or  (None, None).
+
+    Uses the FAISS index when there is one, otherwise an exact scan (one GEMV).
+    """
+    if not gallery_ids:
+        return None, None
+    if index is not None:
+        sims, idx = index.search(query[None, :], 1)
+        best, sim = int(idx[0, 0]), float(sims[0, 0])
+        if best < 0:
+            return None, None
+    else:
+        sims      = gallery @ query
+        best      = int(np.argmax(sims))
+        sim       = float(sims[best])
+    distance = 1.0 - sim
+    if distance > MATCH_DISTANCE:
+        return None, None
+    return gallery_ids[best], distance
+
+
+_GPU_DEVICES = None
+
+
+def _gpu_devices():
+    """GPUs visible to TensorFlow.  Enumerated lazily: it initialises CUDA, which must
+    happen in the process that runs inference, never in a parent that forks later."""
+    global _GPU_DEVICES
+    if _GPU_DEVICES is None:
+        _GPU_DEVICES = [d.name for d in tf.config.list_physical_devices("GPU")]
+    return _GPU_DEVICES
+
+
+def warm_up():
+    """Build ArcFace + RetinaFace and the gallery in this process.
+
+    Run per worker, after fork (gunicorn.conf.py post_worker_init): TensorFlow's
+    thread pools do not survive fork(), so no model may run in the Gunicorn master.
+    Only a model that cannot be built is fatal; a missing or unreadable DB_PATH is
+    logged, reported by /test, and the gallery is loaded on the first /recognize.
+    """
+    from deepface.modules.modeling import build_model
+    _arcface_model()
+    build_model(task="face_detector", model_name=DETECTOR_BACKEND)
+    logger.info("TensorFlow GPUs: %s", _gpu_devices() or "none (running on CPU)")
+    # Dummy forward passes (single face and a full micro-batch) so this worker's cuDNN /
+    # TensorRT tuning happens here, not on the first request
+    face = _detect(np.zeros((*ARCFACE_INPUT, 3), dtype=np.uint8), enforce_detection=False)
+    _forward(face[None])
+    _forward(np.repeat(face[None], BATCH_MAX, axis=0))
+    try:
+        _load_gallery(wait=True)
+    except Exception as exc:
+        logger.warning("Gallery not loaded during warm-up, retrying on the first request: %s", exc)
 
 
 # ─────────────────────────────────────────────
 #  Flask app
 # ─────────────────────────────────────────────
 app = Flask(__name__, static_folder=None)
-CORS(app, origins=os.environ.get("ALLOWED_ORIGINS", "*"))
+# Pre-flights are answered by Flask's automatic OPTIONS handling (the view never runs);
+# max_age lets browsers reuse the result for 24 h instead of re-asking before every POST.
+CORS(app, origins=os.environ.get("ALLOWED_ORIGINS", "*"), max_age=86400)
+
+
+def _json(obj, status=200):
+    """JSON response encoded with orjson;  obj  may already be encoded bytes (cached results)."""
+    body = obj if isinstance(obj, bytes) else orjson.dumps(obj)
+    return Response(body, status=status, mimetype="application/json")
 
 
 # ── Serve the frontend ──────────────────────
@@ -65,130 +704,140 @@ def static_files(filename):
 
 
 # ── Health check ────────────────────────────
-@app.route("/test")
-def test():
-    return jsonify({
+#    Uptime monitors may poll every second; the filesystem is only checked every PROBE_TTL s.
+PROBE_TTL   = 5.0
+_last_probe = (float("-inf"), None)          # (monotonic time, encoded body)
+
+
+def _probe():
+    global _last_probe
+    now = time.monotonic()
+    if now - _last_probe[0] < PROBE_TTL:
+        return _last_probe[1]
+    body = orjson.dumps({
         "status":      "ok",
         "excel_found": os.path.exists(EXCEL_PATH),
         "excel_path":  EXCEL_PATH,
         "db_found":    os.path.exists(DB_PATH),
         "db_path":     DB_PATH,
+        "gpu":         _gpu_devices(),
     })
+    _last_probe = (now, body)
+    return body
+
+
+@app.route("/test")
+def test():
+    return _json(_probe())
 
 
 # ── Face Recognition ────────────────────────
-@app.route("/recognize", methods=["POST", "OPTIONS"])
+@app.route("/recognize", methods=["POST"])
 def recognize():
-    # CORS pre-flight
-    if request.method == "OPTIONS":
-        return jsonify({"ok": True}), 200
-
     logger.info("POST /recognize – request received")
 
-    # 1. Parse JSON body
-    data = request.get_json(silent=True)
-    if not data:
+    # 1. Parse JSON body straight from the raw request bytes
+    try:
+        data = orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        data = None
+    if not data or not isinstance(data, dict):
         logger.warning("No JSON body in request")
-        return jsonify({"error": "No JSON body received"}), 400
+        return _json({"error": "No JSON body received"}, 400)
 
     image_b64 = data.get("image")
     if not image_b64:
         logger.warning("'image' field missing from JSON")
-        return jsonify({"error": "'image' field missing"}), 400
+        return _json({"error": "'image' field missing"}, 400)
 
-    # 2. Decode base64 image → temp file
-    #    Use a proper temp file so concurrent workers don't collide
-    tmp_path = None
+    # 2. Decode base64 → raw bytes; an identical image is answered from the cache
     try:
-        if "," in image_b64:                       # strip data-URL prefix
-            image_b64 = image_b64.split(",", 1)[1]
-
-        img_bytes = base64.b64decode(image_b64)
-        image     = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-
-        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as tmp:
-            tmp_path = tmp.name
-        image.save(tmp_path, format="JPEG", quality=95)
-        logger.info("Image decoded, size=%s, saved to %s", image.size, tmp_path)
+        payload   = image_b64.encode("ascii")
+        comma     = payload.find(b",")               # strip data-URL prefix
+        img_bytes = binascii.a2b_base64(memoryview(payload)[comma + 1:])
+        if not img_bytes:
+            raise ValueError("empty image")
     except Exception as exc:
         logger.error("Image decode error: %s", exc)
-        _cleanup(tmp_path)
-        return jsonify({"error": f"Could not decode image: {exc}"}), 400
-
-    # 3. Run DeepFace recognition
+        return _json({"error": f"Could not decode image: {exc}"}, 400)
+
+    cache_key  = hashlib.sha1(img_bytes).digest()
+    generation = _RESULT_CACHE.generation           # read before the gallery / names it is computed from
+    cached     = None if _sources_changed() else _RESULT_CACHE.get(cache_key)
+    if cached is not None:
+        logger.info("Result cache hit")
+        return _json(cached)
+
+    # 3. Aligned face from the detection cache (retried frames), else decode the bytes
+    face = _DETECT_CACHE.get(cache_key)
+    if face is None:
+        try:
+            arr = _decode(img_bytes)
+        except cv2.error as exc:
+            logger.error("Image decode error: %s", exc)
+            return _json({"error": f"Could not decode image: {exc}"}, 400)
+        if arr is None:
+            logger.error("Image decode error: not a supported image format")
+            return _json({"error": "Could not decode image: not a supported image format"}, 400)
+        logger.info("Image decoded, size=%dx%d", arr.shape[1], arr.shape[0])
+        arr = _downscale(arr)
+    else:
+        logger.info("Detection cache hit")
+
+    # 4. Detect (on a miss), embed the probe and score it against the gallery
     try:
-        logger.info("Running DeepFace.find  db_path='%s'", DB_PATH)
-        DeepFace = _deepface()
-        results  = DeepFace.find(
-            img_path          = tmp_path,
-            db_path           = DB_PATH,
-            model_name        = "ArcFace",
-            detector_backend  = "retinaface",
-            distance_metric   = "cosine",
-            enforce_detection = True,
-            silent            = True,
-        )
-        logger.info("DeepFace returned %d result dataframe(s)", len(results))
+        logger.info("Embedding probe, gallery db_path='%s'", DB_PATH)
+        gallery, gallery_ids, index = _load_gallery()
+        _load_names()                                 # also on no-face / no-match, so _sources_changed() settles
+        if face is None:
+            face = _DETECT_CACHE.put(cache_key, _detect(arr, enforce_detection=True))
+        query = _l2_normalize(_embed(face))
+        logger.info("Probe embedded")
     except Exception as exc:
         traceback.print_exc()
-        _cleanup(tmp_path)
         msg = str(exc)
         if "Face could not be detected" in msg or "No face" in msg:
-            return jsonify({
+            return _json(_RESULT_CACHE.put(cache_key, orjson.dumps({
                 "match": False, "confidence": 0,
                 "person_id": None, "person_name": None,
                 "message": "No face detected in image",
-            })
-        return jsonify({"error": f"DeepFace error: {msg}"}), 500
-    finally:
-        _cleanup(tmp_path)
+            }), generation))
+        return _json({"error": f"DeepFace error: {msg}"}, 500)
 
-    # 4. Parse results
-    if not results or results[0].empty:
+    # 5. Nearest neighbour in the gallery
+    person_id, distance = _best_match(gallery, gallery_ids, index, query)
+    if person_id is None:
         logger.info("No match found in database")
-        return jsonify({
+        return _json(_RESULT_CACHE.put(cache_key, orjson.dumps({
             "match": False, "confidence": 0,
             "person_id": None, "person_name": None,
             "message": "No match found in database",
-        })
+        }), generation))
 
-    best       = results[0].iloc[0]
-    distance   = float(best["distance"])
     confidence = round((1 - distance) * 100, 1)
     matched    = (1 - distance) >= CONFIDENCE_THRESHOLD
-    person_id  = os.path.splitext(os.path.basename(best["identity"]))[0]
 
     logger.info("Best match: person_id=%s  distance=%.4f  confidence=%.1f%%  matched=%s",
                 person_id, distance, confidence, matched)
 
-    # 5. Look up name in Excel
+    # 6. Look up name in Excel
     person_name = None
     try:
-        df  = pd.read_excel(EXCEL_PATH)
-        row = df[df["Inmate Id"].astype(str) == str(person_id)]
-        if not row.empty:
-            person_name = str(row.iloc[0]["Name"])
+        person_name = _load_names().get(str(person_id))
+        if person_name is not None:
             logger.info("Name resolved: %s", person_name)
         else:
             logger.warning("person_id '%s' not found in Excel", person_id)
     except Exception as exc:
         logger.warning("Could not read Excel: %s", exc)
 
-    return jsonify({
+    return _json(_RESULT_CACHE.put(cache_key, orjson.dumps({
         "match":       matched,
         "confidence":  confidence,
         "person_id":   person_id,
         "person_name": person_name or f"ID: {person_id} (name not found)",
         "distance":    distance,
-    })
-
-
-def _cleanup(path):
-    if path and os.path.exists(path):
-        try:
-            os.remove(path)
-        except OSError:
-            pass
+    }), generation))
 
 
 # ─────────────────────────────────────────────
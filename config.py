@@ -0,0 +1,48 @@
+"""
+config.py  –  Safe Return  |  shared settings
+
+Paths, model choices and tuning knobs (override via environment variables), plus the
+ArcFace input preparation shared by api.py and export_onnx.py.
+Importing this module has no side effects: no TensorFlow, no file I/O, no threads.
+"""
+
+import os
+
+import numpy as np
+
+
+# ─────────────────────────────────────────────
+#  Config  (override via environment variables)
+# ─────────────────────────────────────────────
+BASE_DIR             = os.path.dirname(os.path.abspath(__file__))
+EXCEL_PATH           = os.environ.get("EXCEL_PATH",  os.path.join(BASE_DIR, "sheet.xlsx"))
+DB_PATH              = os.environ.get("DB_PATH",     os.path.join(BASE_DIR, "data"))
+STATIC_DIR           = os.environ.get("STATIC_DIR",  os.path.join(BASE_DIR, "static"))
+CONFIDENCE_THRESHOLD = float(os.environ.get("CONFIDENCE_THRESHOLD", "0.6"))
+ARCFACE_ONNX         = os.environ.get("ARCFACE_ONNX", os.path.join(BASE_DIR, "arcface.onnx"))
+SHEET_PARQUET        = os.environ.get("SHEET_PARQUET", os.path.splitext(EXCEL_PATH)[0] + ".parquet")
+GALLERY_NPY          = os.environ.get("GALLERY_NPY",  os.path.join(BASE_DIR, "gallery.npy"))
+GALLERY_META         = os.path.splitext(GALLERY_NPY)[0] + "_ids.json"
+GALLERY_FAISS        = os.path.splitext(GALLERY_NPY)[0] + ".faiss"
+
+MODEL_NAME       = "ArcFace"
+DETECTOR_BACKEND = "retinaface"
+MATCH_DISTANCE   = 0.68          # DeepFace's ArcFace/cosine cut-off (what DeepFace.find filtered on)
+IMAGE_EXTS       = (".jpg", ".jpeg", ".png")
+ARCFACE_INPUT    = (112, 112)
+DETECT_MAX_SIDE  = 640           # probes are downscaled to this before RetinaFace
+TRT_CALIBRATION  = "calibration.flatbuffers"   # INT8 table written by export_onnx.py --calibrate
+BATCH_MAX        = int(os.environ.get("BATCH_MAX", "16"))          # faces per ArcFace forward pass
+BATCH_WAIT_MS    = float(os.environ.get("BATCH_WAIT_MS", "10"))    # how long to gather a batch
+FAISS_MIN_SIZE   = int(os.environ.get("FAISS_MIN_SIZE", "10000"))   # exact scan below this
+RESULT_CACHE_MAX = int(os.environ.get("RESULT_CACHE_MAX", "256"))
+DETECT_CACHE_MAX = int(os.environ.get("DETECT_CACHE_MAX", "1024"))   # > RESULT_CACHE_MAX, or it never hits
+
+
+# ─────────────────────────────────────────────
+#  ArcFace input  (identical at serve, export and calibration time)
+# ─────────────────────────────────────────────
+def arcface_input(face_rgb):
+    """extract_faces crop (RGB, 0–1) → (1,112,112,3) float32 BGR, prepared as DeepFace.represent does."""
+    from deepface.modules.preprocessing import resize_image
+    return resize_image(face_rgb[:, :, ::-1], ARCFACE_INPUT).astype(np.float32, copy=False)
@@ -0,0 +1,75 @@
+"""
+export_onnx.py  –  One-off export of DeepFace's ArcFace model to ONNX
+
+    python export_onnx.py               # → arcface.onnx  (FP32)
+    python export_onnx.py --calibrate   # + calibration.flatbuffers  (TensorRT INT8)
+
+api.py picks up ARCFACE_ONNX (default ./arcface.onnx) in each worker when onnxruntime
+is installed and serves ArcFace from it instead of TensorFlow.  With the calibration
+table next to the model the TensorRT execution provider runs it in INT8.
+RetinaFace detection still runs through DeepFace either way.
+
+Extra packages (not needed by the API itself):
+    pip install tf2onnx onnxruntime-gpu
+"""
+
+import os
+import sys
+import logging
+
+import numpy as np
+import tensorflow as tf
+import tf2onnx
+from deepface import DeepFace
+
+# config, not api: importing api would open a session on the arcface.onnx about to be overwritten
+from config import (ARCFACE_INPUT, ARCFACE_ONNX, DB_PATH, DETECTOR_BACKEND, IMAGE_EXTS,
+                    MODEL_NAME, TRT_CALIBRATION, arcface_input)
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s – %(message)s")
+logger = logging.getLogger("safe_return.export")
+
+
+def export():
+    model = DeepFace.build_model(MODEL_NAME).model
+    spec  = (tf.TensorSpec((None, *ARCFACE_INPUT, 3), tf.float32, name="input"),)
+    tf2onnx.convert.from_keras(model, input_signature=spec, opset=13, output_path=ARCFACE_ONNX)
+    logger.info("Wrote %s", ARCFACE_ONNX)
+
+
+def calibrate():
+    """Write the INT8 calibration table from the gallery photos (aligned exactly as at serve time)."""
+    from onnxruntime.quantization import CalibrationDataReader, create_calibrator, write_calibration_table
+
+    class GalleryReader(CalibrationDataReader):
+        def __init__(self, input_name):
+            paths = [os.path.join(DB_PATH, f) for f in sorted(os.listdir(DB_PATH))
+                     if f.lower().endswith(IMAGE_EXTS)]
+            self._feeds = iter(
+                {input_name: arcface_input(DeepFace.extract_faces(
+                    img_path=p, detector_backend=DETECTOR_BACKEND, enforce_detection=False,
+                )[0]["face"])}
+                for p in paths
+            )
+
+        def get_next(self):
+            return next(self._feeds, None)
+
+    onnx_dir   = os.path.dirname(os.path.abspath(ARCFACE_ONNX))
+    calibrator = create_calibrator(ARCFACE_ONNX, [],
+                                   augmented_model_path=os.path.join(onnx_dir, "arcface.augmented.onnx"))
+    calibrator.set_execution_providers(["CUDAExecutionProvider", "CPUExecutionProvider"])
+    calibrator.collect_data(GalleryReader(calibrator.model.graph.input[0].name))
+    write_calibration_table(calibrator.compute_data(), dir=onnx_dir)
+    logger.info("Wrote %s", os.path.join(onnx_dir, TRT_CALIBRATION))
+
+
+if __name__ == "__main__":
+    export()
+    if "--calibrate" in sys.argv[1:]:
+        calibrate()
+    # Sanity check: the exported graph accepts the serving input shape
+    import onnxruntime as ort
+    sess = ort.InferenceSession(ARCFACE_ONNX, providers=["CPUExecutionProvider"])
+    out  = sess.run(None, {sess.get_inputs()[0].name: np.zeros((1, *ARCFACE_INPUT, 3), np.float32)})
+    logger.info("ONNX output shape: %s", out[0].shape)
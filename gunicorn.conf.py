@@ -0,0 +1,41 @@
+"""
+gunicorn.conf.py  –  Gunicorn settings for Safe Return Face Recognition API
+(picked up automatically when gunicorn is started from this directory)
+
+    gunicorn wsgi:application --bind 0.0.0.0:8000
+
+One worker holds ~1 GB of TensorFlow weights, so concurrency comes from threads:
+while one thread runs /recognize the others keep answering /test and CORS pre-flights.
+Command-line flags still override anything set here.
+"""
+
+import os
+
+worker_class = "gthread"
+workers      = int(os.environ.get("GUNICORN_WORKERS", "1"))
+threads      = int(os.environ.get("GUNICORN_THREADS", "4"))
+preload_app  = False         # TensorFlow must not run before fork – see post_worker_init
+timeout      = 120
+accesslog    = "-"
+errorlog     = "-"
+
+
+def post_worker_init(worker):
+    """Build the models, warm them up and load the gallery inside the worker process.
+
+    The first gallery build can outlast  timeout, so keep telling the arbiter we are alive.
+    """
+    import threading
+    from api import warm_up
+
+    done = threading.Event()
+
+    def heartbeat():
+        while not done.wait(timeout / 4):
+            worker.notify()
+
+    threading.Thread(target=heartbeat, name="warm-up-heartbeat", daemon=True).start()
+    try:
+        warm_up()
+    finally:
+        done.set()
@@ -1,23 +1,21 @@
 """
 wsgi.py  –  Gunicorn entry-point for Safe Return Face Recognition API
 
-Run locally:
-    gunicorn wsgi:application --bind 0.0.0.0:5000 --workers 2 --timeout 120
+Run (settings come from gunicorn.conf.py: gthread, 1 worker × 4 threads):
+    gunicorn wsgi:application --bind 0.0.0.0:8000
 
-Production (recommended):
-    gunicorn wsgi:application \
-        --bind 0.0.0.0:8000 \
-        --workers 2 \
-        --threads 2 \
-        --worker-class gthread \
-        --timeout 120 \
-        --access-logfile - \
-        --error-logfile -
-
-NOTE: Keep --workers low (1-2). DeepFace loads a large model into memory per worker.
+NOTE: Do not run with --preload / preload_app. The models must be built inside each
+worker (gunicorn.conf.py calls api.warm_up() in post_worker_init) – TensorFlow
+cannot keep running in a process forked after it has executed ops.
 """
 
-from api import app as application  # noqa: F401  (Gunicorn looks for "application")
+import os
+
+# Must be set before TensorFlow is imported (via api → deepface)
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "0")
+os.environ.setdefault("TF_FORCE_GPU_ALLOW_GROWTH", "true")
+
+from api import app as application  # noqa: E402,F401  (Gunicorn looks for "application")
 
 if __name__ == "__main__":
     # Fallback – lets you still do `python wsgi.py` for quick local dev